@@ -1,15 +1,25 @@
 import streamlit as st
 import pandas as pd
-import gspread
+import numpy as np
 from google.oauth2.service_account import Credentials
-from gspread_dataframe import get_as_dataframe
+from google.auth.transport.requests import AuthorizedSession
 import plotly.express as px
+import altair as alt
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import RunReportRequest, Dimension, Metric, DateRange, OrderBy
+import grpc
+from google.analytics.data_v1beta.types import BatchRunReportsRequest, RunReportRequest, Dimension, Metric, DateRange, OrderBy
 import google.generativeai as genai
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import math
+from datetime import date, timedelta
+import hashlib
+import time
+from site_registry import load_sites, sheet_id_from_url
+
+# --- GA4レポートの定義（リクエストごとに作り直さず使い回す） ---
+_M_USERS, _M_SESSIONS, _M_CONV, _M_DUR = Metric(name="activeUsers"), Metric(name="sessions"), Metric(name="conversions"), Metric(name="averageSessionDuration")
+_M_VIEWS = Metric(name="screenPageViews")
+_D_CHANNEL, _D_DEVICE, _D_AGE, _D_PAGE = Dimension(name="sessionDefaultChannelGroup"), Dimension(name="deviceCategory"), Dimension(name="userAgeBracket"), Dimension(name="pageTitle")
+_O_USERS_DESC = OrderBy(metric={'metric_name': 'activeUsers'}, desc=True)
+_O_VIEWS_DESC = OrderBy(metric={'metric_name': 'screenPageViews'}, desc=True)
 
 # --- アプリの基本設定 ---
 st.set_page_config(page_title="経営層向け GA4分析ダッシュボード", page_icon="🚀", layout="wide")
@@ -21,7 +31,6 @@ def authorize_gcp():
     try:
         scopes = [
             "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
             "https://www.googleapis.com/auth/analytics.readonly"
         ]
         creds = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scopes)
@@ -33,6 +42,7 @@ def authorize_gcp():
 credentials = authorize_gcp()
 GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
 GOOGLE_SHEET_URL = st.secrets["GOOGLE_SHEET_URL"]
+SHEET_ID = sheet_id_from_url(GOOGLE_SHEET_URL)
 
 # --- UI表示 ---
 st.title("🚀 経営層向け GA4分析ダッシュボード")
@@ -41,51 +51,156 @@ st.write("サイトの現状をひと目で把握し、データに基づいた
 # --- ヘルパー関数 ---
 @st.cache_resource
 def get_ga_client():
-    """GA4のクライアントを初期化"""
-    return BetaAnalyticsDataClient(credentials=credentials)
+    """GA4のクライアントを初期化し、gRPCチャネルを事前に接続しておく"""
+    client = BetaAnalyticsDataClient(
+        credentials=credentials,
+        transport="grpc",
+        client_options={"api_endpoint": "analyticsdata.googleapis.com"},
+    )
+    try:
+        # 初回のレポート取得時にTLSハンドシェイクを待たずに済むよう接続を確立
+        grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=2)
+    except Exception:
+        pass  # 接続に失敗しても、最初のリクエスト時に改めて接続される
+    return client
 
 @st.cache_resource
-def get_gsheet_client():
-    """Googleスプレッドシートのクライアントを初期化"""
-    return gspread.authorize(credentials)
+def get_sheets_session():
+    """Google Sheets API用のセッションを初期化"""
+    return AuthorizedSession(credentials)
 
-@st.cache_data(ttl=600) # 10分間キャッシュ
-def get_sites_data(_gsheet_client):
-    """スプレッドシートからサイト一覧を取得"""
+def get_sites_data():
+    """スプレッドシートからサイト一覧を {サイト名: プロパティID} の辞書で取得"""
     try:
-        sheet = _gsheet_client.open_by_url(GOOGLE_SHEET_URL).sheet1
-        df = get_as_dataframe(sheet, evaluate_formulas=True).dropna(how='all')
-        return df
+        sites = {}
+        for name, pid in load_sites(get_sheets_session(), SHEET_ID).values():
+            # 同名のサイトが複数行ある場合は、設定ページと同じく先頭の行を使う
+            if pid != "":
+                sites.setdefault(name, pid)
+        return sites
     except Exception as e:
         st.error(f"Googleスプレッドシートの読み込みに失敗しました: {e}")
-        return pd.DataFrame()
+        return {}
+
+@st.cache_resource
+def get_gemini_model():
+    """Gemini APIを認証し、モデルを初期化（プロセスごとに1回だけ実行）"""
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+_REPORT_TTL, _REPORT_MAX_ENTRIES = 3600, 100
+
+@st.cache_resource
+def get_report_store():
+    """生成済みのAIレポートを {プロンプトのハッシュ: (生成時刻, 本文)} で保持する"""
+    return {}
+
+def gemini_report(prompt):
+    """Geminiで分析レポートを生成し、生成された部分から順に表示する
+
+    同じプロンプトのレポートが保持されていれば、生成済みの本文を1回で描画する。
+    """
+    store = get_report_store()
+    key = hashlib.sha256(prompt.encode()).hexdigest()
+    cached = store.get(key)
+    if cached is not None and time.time() - cached[0] < _REPORT_TTL:
+        st.markdown(cached[1])
+        return cached[1]
+    report = st.write_stream(chunk.text for chunk in get_gemini_model().generate_content(prompt, stream=True))
+    store.pop(key, None)
+    store[key] = (time.time(), report)
+    while len(store) > _REPORT_MAX_ENTRIES:
+        store.pop(next(iter(store)))  # 古いものから捨てる
+    return report
+
+def run_ga4_batch_report(client, property_id, requests):
+    """複数のレポートリクエストを1回のAPI呼び出しでGA4に送信する（最大5件）"""
+    request = BatchRunReportsRequest(property=f"properties/{property_id}", requests=requests)
+    return client.batch_run_reports(request).reports
+
+def _date_windows(day):
+    """基準日から（直近30日間の開始日, 前30日間の開始日, 前30日間の終了日）を求める"""
+    t = date.fromisoformat(day)
+    return (t - timedelta(days=29)).isoformat(), (t - timedelta(days=59)).isoformat(), (t - timedelta(days=30)).isoformat()
 
-def run_ga4_report(client, property_id, dimensions, metrics, date_ranges, order_bys=None):
-    """GA4にレポートリクエストを送信する汎用関数"""
-    request = RunReportRequest(property=f"properties/{property_id}", dimensions=dimensions, metrics=metrics, date_ranges=date_ranges, order_bys=order_bys)
-    return client.run_report(request)
+_KPI_METRICS = [_M_USERS, _M_SESSIONS, _M_CONV, _M_DUR]
+
+def kpi_values(response):
+    """主要指標（ユーザー数, 訪問回数, CV数, 平均滞在時間）のレスポンスを数値のリストにする"""
+    return [float(v.value) for v in response.rows[0].metric_values] if response.rows else [0, 0, 0, 0]
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def kpi_prev(property_id, prev_start, prev_end):
+    """前30日間の主要指標を取得（期間が確定済みのため長めにキャッシュ）"""
+    request = RunReportRequest(property=f"properties/{property_id}", metrics=_KPI_METRICS, date_ranges=[DateRange(start_date=prev_start, end_date=prev_end)])
+    return kpi_values(get_ga_client().run_report(request))
+
+@st.cache_data(ttl=1800, show_spinner=False)
+def fetch_reports(property_id, date_key):
+    """直近30日間の主要指標と詳細レポートを取得し、キャッシュ可能な形式（pandas）に整形して返す
+
+    date_key は基準日（今日）。集計期間はここから一意に決まる。
+    """
+    ga_client = get_ga_client()
+    start = _date_windows(date_key)[0]
+    date_range_current = DateRange(start_date=start, end_date="today")
+    req_kpi = RunReportRequest(metrics=_KPI_METRICS, date_ranges=[date_range_current])
+    req_details = RunReportRequest(dimensions=[_D_DEVICE, _D_AGE], metrics=[_M_USERS], date_ranges=[date_range_current])
+    # TOP5の絞り込みはGA4側で行い、必要な行だけを受け取る
+    req_channels = RunReportRequest(dimensions=[_D_CHANNEL], metrics=[_M_USERS], date_ranges=[date_range_current], order_bys=[_O_USERS_DESC], limit=5)
+    req_pages = RunReportRequest(dimensions=[_D_PAGE], metrics=[_M_VIEWS], date_ranges=[date_range_current], order_bys=[_O_VIEWS_DESC], limit=5)
+    response_kpi, response_details, response_channels, response_pages = run_ga4_batch_report(ga_client, property_id, [req_kpi, req_details, req_channels, req_pages])
+    # 詳細データ
+    rows = response_details.rows
+    df_details = pd.DataFrame({
+        "デバイス": [r.dimension_values[0].value for r in rows],
+        "年齢層": [r.dimension_values[1].value for r in rows],
+        "ユーザー数": np.fromiter((int(r.metric_values[0].value) for r in rows), dtype=np.int64, count=len(rows)),
+    })
+    # 流入経路 TOP5
+    rows = response_channels.rows
+    df_channel = pd.Series(
+        np.fromiter((int(r.metric_values[0].value) for r in rows), dtype=np.int64, count=len(rows)),
+        index=pd.Index([r.dimension_values[0].value for r in rows], name="チャネル"),
+        name="ユーザー数",
+    )
+    # 人気ページ
+    rows = response_pages.rows
+    df_pages = pd.Series(
+        np.fromiter((int(r.metric_values[0].value) for r in rows), dtype=np.int64, count=len(rows)),
+        index=pd.Index([r.dimension_values[0].value for r in rows], name="ページタイトル"),
+        name="表示回数",
+    )
+    return kpi_values(response_kpi), df_details, df_channel, df_pages
+
+def make_bar_chart(series, sort="-y"):
+    """集計済みのSeriesからAltairの棒グラフを作成"""
+    return alt.Chart(series.reset_index()).mark_bar().encode(
+        x=alt.X(field=series.index.name, type="nominal", sort=sort),
+        y=alt.Y(field=series.name, type="quantitative"),
+    )
 
 def format_duration(seconds):
     """秒数を「X分Y秒」の形式に変換"""
-    if seconds == 0: return "0秒"
-    minutes = math.floor(seconds / 60)
-    remaining_seconds = round(seconds % 60)
-    return f"{minutes}分{remaining_seconds}秒"
+    total = int(round(seconds))
+    if total == 0: return "0秒"
+    # 負の値（前期間との差分）は符号を分けてから分・秒に分ける
+    sign = "-" if total < 0 else ""
+    minutes, remaining_seconds = divmod(abs(total), 60)
+    return f"{sign}{minutes}分{remaining_seconds}秒"
 
 # --- メインロジック ---
 try:
-    gsheet_client = get_gsheet_client()
-    sites = get_sites_data(gsheet_client)
+    sites = get_sites_data()
 
-    if sites.empty:
+    if not sites:
         st.warning("分析対象のサイトが登録されていません。左のメニューから「⚙️ Settings」ページに移動して、サイトを登録してください。")
     else:
-        site_options = sites['SiteName'].tolist()
+        site_options = list(sites.keys())
         selected_site_name = st.selectbox("分析したいサイトを選択してください", site_options)
         
         if selected_site_name:
-            property_id_from_sheet = sites[sites['SiteName'] == selected_site_name]['PropertyID'].iloc[0]
-            selected_property_id = str(int(property_id_from_sheet))
+            selected_property_id = str(int(sites[selected_site_name]))
 
             goal_options = [
                 "サイト経由の売上を増やす",
@@ -99,62 +214,60 @@ try:
                 goal_options
             )
             
-            if st.button("📈 最新ダッシュボードを生成する"):
-                ga_client = get_ga_client()
-                today = datetime.now()
-                last_30_days_start = (today - relativedelta(days=29)).strftime('%Y-%m-%d')
-                prev_30_days_start = (today - relativedelta(days=59)).strftime('%Y-%m-%d')
-                prev_30_days_end = (today - relativedelta(days=30)).strftime('%Y-%m-%d')
-                date_range_current = DateRange(start_date=last_30_days_start, end_date="today")
-                date_range_previous = DateRange(start_date=prev_30_days_start, end_date=prev_30_days_end)
-
+            generate_clicked = st.button("📈 最新ダッシュボードを生成する")
+            if not generate_clicked:
+                # 画面を表示し終えてから、GA4への接続を温めておく
+                # （初回の実行だけ channel_ready_future で最大2秒待つが、画面は描画済みのため意図どおり）
+                get_ga_client()
+            else:
                 with st.spinner("各種データをGA4から取得中..."):
-                    # 主要指標
-                    response_kpi = run_ga4_report(client=ga_client, property_id=selected_property_id, dimensions=[], metrics=[Metric(name="activeUsers"), Metric(name="sessions"), Metric(name="conversions"), Metric(name="averageSessionDuration")], date_ranges=[date_range_current, date_range_previous])
-                    current_metrics = [float(v.value) for v in response_kpi.rows[0].metric_values] if response_kpi.rows else [0, 0, 0, 0]
-                    prev_metrics = [float(v.value) for v in response_kpi.rows[1].metric_values] if len(response_kpi.rows) > 1 else [0, 0, 0, 0]
-                    # 詳細データ
-                    response_details = run_ga4_report(client=ga_client, property_id=selected_property_id, dimensions=[Dimension(name="sessionDefaultChannelGroup"), Dimension(name="deviceCategory"), Dimension(name="userAgeBracket")], metrics=[Metric(name="activeUsers")], date_ranges=[date_range_current])
-                    details_data = [{"チャネル": row.dimension_values[0].value, "デバイス": row.dimension_values[1].value, "年齢層": row.dimension_values[2].value, "ユーザー数": int(row.metric_values[0].value)} for row in response_details.rows]
-                    df_details = pd.DataFrame(details_data)
-                    # 人気ページ
-                    response_pages = run_ga4_report(client=ga_client, property_id=selected_property_id, dimensions=[Dimension(name="pageTitle")], metrics=[Metric(name="screenPageViews")], date_ranges=[date_range_current], order_bys=[OrderBy(metric={'metric_name': 'screenPageViews'}, desc=True)])
-                    page_data = [{"ページタイトル": row.dimension_values[0].value, "表示回数": int(row.metric_values[0].value)} for row in response_pages.rows]
-                    df_pages = pd.DataFrame(page_data).head(5)
+                    today = date.today().isoformat()
+                    _, prev_30_days_start, prev_30_days_end = _date_windows(today)
+                    current_metrics, df_details, df_channel, df_pages = fetch_reports(selected_property_id, today)
+                    # 前期間は確定済みなので、直近期間のバッチとは別に長めにキャッシュする
+                    prev_metrics = kpi_prev(selected_property_id, prev_30_days_start, prev_30_days_end)
 
                 st.header("1. サイトの健康状態")
+                cur = np.array(current_metrics, dtype=np.float64)
+                prev = np.array(prev_metrics, dtype=np.float64)
+                delta = cur - prev
+                # 件数系の指標は一度だけ整数配列に変換し、差分は符号付きで表示する
+                cur_i = np.rint(cur).astype(np.int64)
+                delta_i = cur_i - np.rint(prev).astype(np.int64)
                 kpi_cols = st.columns(4)
-                kpi_cols[0].metric("訪問ユーザー数", f"{int(current_metrics[0]):,}", f"{int(current_metrics[0] - prev_metrics[0]):,}")
-                kpi_cols[1].metric("サイト訪問回数", f"{int(current_metrics[1]):,}", f"{int(current_metrics[1] - prev_metrics[1]):,}")
-                kpi_cols[2].metric("平均サイト滞在時間", format_duration(current_metrics[3]), f"{format_duration(current_metrics[3] - prev_metrics[3])}")
-                kpi_cols[3].metric("成果（CV）数", f"{int(current_metrics[2]):,}", f"{int(current_metrics[2] - prev_metrics[2]):,}")
+                kpi_cols[0].metric("訪問ユーザー数", f"{cur_i[0]:,}", f"{delta_i[0]:+,}")
+                kpi_cols[1].metric("サイト訪問回数", f"{cur_i[1]:,}", f"{delta_i[1]:+,}")
+                kpi_cols[2].metric("平均サイト滞在時間", format_duration(cur[3]), format_duration(delta[3]))
+                kpi_cols[3].metric("成果（CV）数", f"{cur_i[2]:,}", f"{delta_i[2]:+,}")
                 
                 st.header("2. 顧客インサイト")
                 viz_cols = st.columns(4)
+                if not df_channel.empty:
+                    viz_cols[0].altair_chart(make_bar_chart(df_channel), use_container_width=True)
+                else:
+                    viz_cols[0].write("チャネル データなし")
+
                 if not df_details.empty:
-                    df_channel = df_details.groupby("チャネル")["ユーザー数"].sum().nlargest(5); viz_cols[0].bar_chart(df_channel, use_container_width=True)
-                    df_age = df_details.groupby("年齢層")["ユーザー数"].sum().sort_index(); viz_cols[2].bar_chart(df_age, use_container_width=True)
-                    df_device = df_details.groupby("デバイス")["ユーザー数"].sum(); viz_cols[3].bar_chart(df_device, use_container_width=True)
+                    # 元データの走査は1回だけにし、各軸の集計は集約済みの小さなSeriesから求める
+                    grp = df_details.groupby(["年齢層", "デバイス"], sort=False)["ユーザー数"].sum()
+                    df_age = grp.groupby(level="年齢層").sum(); viz_cols[2].altair_chart(make_bar_chart(df_age, sort="ascending"), use_container_width=True)
+                    df_device = grp.groupby(level="デバイス", sort=False).sum(); viz_cols[3].altair_chart(make_bar_chart(df_device), use_container_width=True)
                 else:
-                    viz_cols[0].write("チャネル データなし"); viz_cols[2].write("年齢層 データなし"); viz_cols[3].write("デバイス データなし")
+                    viz_cols[2].write("年齢層 データなし"); viz_cols[3].write("デバイス データなし")
                 
                 if not df_pages.empty:
-                    df_pages_chart = df_pages.set_index("ページタイトル")["表示回数"]; viz_cols[1].bar_chart(df_pages_chart, use_container_width=True)
+                    viz_cols[1].altair_chart(make_bar_chart(df_pages), use_container_width=True)
                 else:
                     viz_cols[1].write("人気ページ データなし")
 
+                st.header("3. AIによる分析と提案")
                 with st.spinner("AIが「次の一手」を分析・提案中..."):
-                    channel_str = df_channel.to_string() if 'df_channel' in locals() and not df_channel.empty else "データなし"
-                    pages_str = df_pages['ページタイトル'].to_string(index=False) if not df_pages.empty else "データなし"
-                    summary_text = f"""# 主要指標: 訪問ユーザー数 {int(current_metrics[0])}, 成果数 {int(current_metrics[2])}, 平均滞在時間 {format_duration(current_metrics[3])}\n# 流入経路 TOP5: {channel_str}\n# 人気ページ TOP5: {pages_str}"""
+                    channel_str = df_channel.to_string() if not df_channel.empty else "データなし"
+                    pages_str = "\n".join(df_pages.index) if not df_pages.empty else "データなし"
+                    summary_text = f"""# 主要指標: 訪問ユーザー数 {cur_i[0]}, 成果数 {cur_i[2]}, 平均滞在時間 {format_duration(cur[3])}\n# 流入経路 TOP5: {channel_str}\n# 人気ページ TOP5: {pages_str}"""
                     prompt = f"""あなたは、企業の成長を支援する腕利きの経営コンサルタントです。以下のWebサイトのデータとビジネス目標を分析し、経営者に向けて「次に取るべき最も重要な一手」を提案してください。\n# ビジネス目標\n{business_goal}\n# 分析対象データ\n{summary_text}\n# 指示\nデータから最大の課題またはチャンスを1つだけ特定し、それに対する具体的なアクションを提案してください。提案は以下のフォーマットで、専門用語を使わずに記述してください。\n---\n### 📊 現状のサマリー\n（データ全体からわかるサイトの健康状態を2行で要約）\n\n### 💡 最も重要な「次の一手」\n**アクション：** （明日からでも始められる、具体的で現実的なアクションを1つだけ提案）\n\n**理由：** （なぜ、今このアクションが最も重要なのかを、データに基づいて解説）\n\n**期待される成果：** （このアクションを実行することで、ビジネス目標達成にどう繋がるかの予測）\n---"""
                     
-                    genai.configure(api_key=GEMINI_API_KEY)
-                    model = genai.GenerativeModel('gemini-1.5-flash')
-                    report = model.generate_content(prompt).text
-                
-                st.header("3. AIによる分析と提案")
-                st.markdown(report)
+                    gemini_report(prompt)
 
 except Exception as e:
     st.error(f"アプリの処理中にエラーが発生しました: {e}")
\ No newline at end of file
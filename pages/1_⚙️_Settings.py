@@ -1,8 +1,9 @@
 import streamlit as st
-import pandas as pd
 import gspread
 from google.oauth2.service_account import Credentials
-from gspread_dataframe import get_as_dataframe, set_with_dataframe
+from google.auth.transport.requests import AuthorizedSession
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from site_registry import load_sites, sheet_id_from_url
 
 st.set_page_config(page_title="設定", page_icon="⚙️", layout="wide")
 
@@ -10,7 +11,7 @@ st.set_page_config(page_title="設定", page_icon="⚙️", layout="wide")
 @st.cache_resource
 def authorize_gcp():
     try:
-        scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+        scopes = ["https://www.googleapis.com/auth/spreadsheets"]
         creds = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=scopes)
         return creds
     except Exception as e:
@@ -19,55 +20,142 @@ def authorize_gcp():
 
 credentials = authorize_gcp()
 GOOGLE_SHEET_URL = st.secrets["GOOGLE_SHEET_URL"]
+SHEET_ID = sheet_id_from_url(GOOGLE_SHEET_URL)
 
 # --- UI ---
 st.title("⚙️ 設定ページ")
 st.write("ここで分析対象のWebサイト情報を登録・管理します。")
 
-# --- メインロジック ---
-try:
-    @st.cache_resource
-    def get_gsheet_client():
-        return gspread.authorize(credentials)
-    
-    gsheet_client = get_gsheet_client()
-    sheet = gsheet_client.open_by_url(GOOGLE_SHEET_URL).sheet1
+# --- ヘルパー関数 ---
+def sheets_retry(*status_codes):
+    """指定したステータスコードのAPIErrorを、指数バックオフで最大4回まで再試行する"""
+    return retry(
+        stop=stop_after_attempt(4),
+        wait=wait_exponential(min=0.5, max=8),
+        retry=retry_if_exception(lambda e: isinstance(e, gspread.exceptions.APIError) and e.response.status_code in status_codes),
+        reraise=True,
+    )
+
+@st.cache_resource
+def get_session():
+    # 読み込み（values.get）と書き込み（gspread）で同じ keep-alive セッションを共有する
+    return AuthorizedSession(credentials)
+
+@st.cache_resource
+def get_sheet():
+    # ワークシートの特定にもAPI呼び出しが必要なため、書き込みを行うときだけ開く
+    client = gspread.Client(auth=credentials, session=get_session())
+    return client.open_by_key(SHEET_ID).sheet1
+
+# 書き込みは500/503だと反映済みの可能性があり、再試行すると二重に実行されるため429のみ再試行する
+@sheets_retry(429)
+def add_sites(rows):
+    """サイトをまとめて登録（1回のAPI呼び出しで複数行を追加できる）"""
+    # サイト名は自由入力のため、数式・日付などとして解釈されないよう RAW で書き込む
+    return get_sheet().append_rows(rows, value_input_option='RAW', insert_data_option='INSERT_ROWS')
+
+@sheets_retry(429)
+def delete_site_row(row):
+    get_sheet().delete_rows(row)
+
+@sheets_retry(429, 500, 503)
+def find_site_row(site_name):
+    # str 以外を渡すと正規表現として扱われるため、必ず文字列で検索する
+    cell = get_sheet().find(str(site_name))
+    return cell.row if cell else None
 
-    st.header("登録済みサイト一覧")
-    sites_df = get_as_dataframe(sheet).dropna(how='all')
-    st.dataframe(sites_df, use_container_width=True)
+@sheets_retry(429, 500, 503)
+def get_site_name(row):
+    # load_sites と同じく UNFORMATTED_VALUE で読み、数値や日付のサイト名も同じ型で比較する
+    values = get_sheet().row_values(row, value_render_option="UNFORMATTED_VALUE")
+    return values[0] if values else None
 
+# 選択ボックスの操作で再実行されるのはこの部分だけにし、一覧表の再描画を避ける
+@st.fragment
+def delete_site_section(site_names):
     st.markdown("---")
-    st.header("新しいサイトを登録")
-    with st.form("add_site_form", clear_on_submit=True):
-        new_site_name = st.text_input("サイト名")
-        new_property_id = st.text_input("GA4プロパティID")
-        submitted_add = st.form_submit_button("このサイトを登録する")
-
-        if submitted_add:
-            if new_site_name and new_property_id:
-                sheet.append_row([new_site_name, str(new_property_id)])
-                st.success(f"「{new_site_name}」を登録しました。")
-                st.cache_data.clear()
-                st.rerun()
-            else:
-                st.warning("サイト名とプロパティIDの両方を入力してください。")
+    st.header("登録済みサイトを削除")
+    with st.expander("削除", expanded=False):
+        site_to_delete = st.selectbox("削除したいサイトを選択してください", options=[""] + site_names)
 
-    if not sites_df.empty:
-        st.markdown("---")
-        st.header("登録済みサイトを削除")
-        site_to_delete = st.selectbox("削除したいサイトを選択してください", options=[""] + sites_df['SiteName'].tolist())
-        
         if st.button("このサイトを削除する", type="primary"):
             if site_to_delete:
-                cell = sheet.find(site_to_delete)
-                if cell:
-                    sheet.delete_rows(cell.row)
+                # 行番号の対応表は削除を実行するときだけ作る
+                sites = st.session_state.sites
+                row_map = {}
+                for i, (name, _) in sites.items():
+                    row_map.setdefault(name, i)
+                try:
+                    row = row_map.get(site_to_delete)
+                    # 他の人が同時に編集していると行番号がずれるため、削除直前にその行の内容を確認する
+                    row_moved = row is None or get_site_name(row) != site_to_delete
+                    if row_moved:
+                        # ずれていた場合はシート上を検索して行番号を求め直し、もう一度確認する
+                        row = find_site_row(site_to_delete)
+                        if row is None or get_site_name(row) != site_to_delete:
+                            st.toast("シートが他の操作で更新されていたため、一覧を読み込み直しました。もう一度お試しください。", icon="⚠️")
+                            load_sites.clear()
+                            st.session_state.pop("sites", None)
+                            st.rerun()
+                    delete_site_row(row)
                     st.success(f"「{site_to_delete}」を削除しました。")
-                    st.cache_data.clear()
+                    # 他のセッションやダッシュボードが古い一覧を使わないよう、共有キャッシュを破棄する
+                    load_sites.clear()
+                    if row_moved:
+                        # 手元の一覧は行番号が古いため、シートから読み直す
+                        st.session_state.pop("sites", None)
+                    else:
+                        # 手元の一覧からも削除し、以降の行番号を1つずつ詰める
+                        st.session_state.sites = {(i - 1 if i > row else i): v for i, v in sites.items() if i != row}
                     st.rerun()
+                except Exception as e:
+                    st.error(f"サイトの削除に失敗しました: {e}")
             else:
                 st.warning("削除するサイトを選択してください。")
 
+# --- メインロジック ---
+st.header("登録済みサイト一覧")
+try:
+    if st.button("🔄 最新の情報に更新"):
+        load_sites.clear()
+        st.session_state.pop("sites", None)
+    # 一覧はセッション内で保持し、登録・削除時はシートを読み直さずに手元で更新する
+    if "sites" not in st.session_state:
+        st.session_state.sites = load_sites(get_session(), SHEET_ID)
 except Exception as e:
-    st.error(f"エラーが発生しました: {e}")
\ No newline at end of file
+    st.error(f"サイト一覧の読み込みに失敗しました: {e}")
+    st.stop()
+sites = st.session_state.sites
+site_names = [name for name, _ in sites.values()]
+st.dataframe([{"SiteName": name, "PropertyID": pid} for name, pid in sites.values()], use_container_width=True)
+
+st.markdown("---")
+st.header("新しいサイトを登録")
+with st.form("add_site_form", clear_on_submit=True):
+    new_site_name = st.text_input("サイト名")
+    new_property_id = st.text_input("GA4プロパティID")
+    submitted_add = st.form_submit_button("このサイトを登録する")
+
+    if submitted_add:
+        if new_site_name and new_property_id:
+            if not new_property_id.strip().isdecimal():
+                st.warning("GA4プロパティIDは数字のみで入力してください。")
+            else:
+                property_id = int(new_property_id.strip())
+                try:
+                    result = add_sites([[new_site_name, property_id]])
+                except Exception as e:
+                    st.error(f"サイトの登録に失敗しました: {e}")
+                else:
+                    st.success(f"「{new_site_name}」を登録しました。")
+                    # 他のセッションやダッシュボードが古い一覧を使わないよう、共有キャッシュを破棄する
+                    load_sites.clear()
+                    # 追加された行番号（例: "Sheet1!A5:B5" → 5）で手元の一覧にも追加
+                    new_row = gspread.utils.a1_to_rowcol(result["updates"]["updatedRange"].split("!")[-1].split(":")[0])[0]
+                    st.session_state.sites[new_row] = [new_site_name, property_id]
+                    st.rerun()
+        else:
+            st.warning("サイト名とプロパティIDの両方を入力してください。")
+
+if sites:
+    delete_site_section(site_names)
\ No newline at end of file
@@ -0,0 +1,30 @@
+import streamlit as st
+import re
+
+_SHEET_ID_RE = re.compile(r"/spreadsheets/d/([a-zA-Z0-9_-]+)")
+
+def sheet_id_from_url(url):
+    """スプレッドシートのURLからIDを取り出す（読み取れない場合はエラーを表示して停止）"""
+    match = _SHEET_ID_RE.search(url)
+    if match is None:
+        st.error("GOOGLE_SHEET_URL（Secrets）からスプレッドシートIDを読み取れませんでした。URLを確認してください。")
+        st.stop()
+    return match.group(1)
+
+# --- サイト一覧（ダッシュボードと設定ページで共有） ---
+# 両ページが同じ関数をインポートするため、設定ページで load_sites.clear() を呼べば
+# ダッシュボード側のサイト一覧も最新になる。
+# 長時間動かしてもメモリが増え続けないよう、エントリ数にも上限を設ける
+# （Streamlit公式ドキュメント「Common app problems: Resource limits」参照）
+@st.cache_data(ttl=300, max_entries=1, show_spinner=False)
+def load_sites(_session, sheet_id):
+    """サイト一覧を {シート上の行番号: [サイト名, プロパティID]} の辞書で取得"""
+    # 必要な2列（SiteName, PropertyID）だけを1回のリクエストで取得する（1行目はヘッダー）
+    response = _session.get(
+        f"https://sheets.googleapis.com/v4/spreadsheets/{sheet_id}/values/A2:B",
+        # レスポンスはセルの値だけに絞る（range, majorDimension などは不要）
+        params={"valueRenderOption": "UNFORMATTED_VALUE", "fields": "values"},
+    )
+    response.raise_for_status()
+    rows = response.json().get("values", [])
+    return {i: r + [""] * (2 - len(r)) for i, r in enumerate(rows, start=2) if r and r[0]}